@@ -1,13 +1,15 @@
 import streamlit as st
-import requests
+import asyncio
+import functools
+import hashlib
 import json
-import time
 import os
+import random
+import time
 import re
-import shutil
 import zipfile
 from io import BytesIO
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import httpx
 from PIL import Image
 from google import genai
 from google.genai import types
@@ -17,18 +19,55 @@ from google.genai import types
 # ==========================================
 st.set_page_config(page_title="열정피디 AI 유튜브 대본 구조 분석기 (Pro)", layout="wide", page_icon="🎬")
 
-# 파일 저장 경로 설정
-BASE_PATH = "./web_result_files"
-IMAGE_OUTPUT_DIR = os.path.join(BASE_PATH, "output_images")
-
 # 텍스트 모델 설정
 GEMINI_TEXT_MODEL_NAME = "gemini-2.5-pro"
 
+def api_key_digest(api_key):
+    """캐시 키용 API 키 해시 (원본 키가 캐시 키에 노출되지 않도록 솔트 적용)"""
+    return hashlib.sha256(("ai-scene-maker::" + api_key).encode()).hexdigest()[:16]
+
+@st.cache_resource(show_spinner=False)
+def get_genai_client(api_key: str) -> genai.Client:
+    """세션 전체에서 재사용할 Gemini 클라이언트 (커넥션 풀/인증 상태 유지)"""
+    # 동시 장면 생성 폭에 맞게 keep-alive 풀을 키워, 병렬 호출마다 TLS 핸드셰이크가 새로 생기지 않게 함
+    pool_limits = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            client_args={"limits": pool_limits},
+            async_client_args={"limits": pool_limits},
+        )
+    )
+
+class AsyncRateLimiter:
+    """
+    토큰 버킷 기반 속도 제한기 - 429가 터지고 나서 기다리는 대신 호출 속도를 선제적으로 제한.
+    cost=1이면 QPS(초당 요청 수) 버킷, cost에 예상 토큰 수를 주면 TPM(분당 토큰) 버킷으로 동작.
+    """
+    def __init__(self, max_rate, time_period=1.0):
+        self.rate = max_rate / time_period
+        self.max_tokens = float(max_rate)
+        self._tokens = float(max_rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, cost=1.0):
+        cost = min(float(cost), self.max_tokens)  # 용량보다 큰 요청으로 영구 대기하지 않도록
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= cost:
+                    self._tokens -= cost
+                    return
+                await asyncio.sleep((cost - self._tokens) / self.rate)
+
 # ==========================================
 # [함수] 1. 대본 구조화 로직
 # ==========================================
-def generate_structure(client, full_script):
-    """Gemini를 이용해 대본 구조화"""
+def generate_structure(client, full_script, on_chunk=None):
+    """Gemini 스트리밍 호출로 대본 구조화 (토큰이 도착하는 대로 수신/표시)"""
     prompt = f"""
     [Role]
     You are a professional YouTube Content Editor and Scriptwriter.
@@ -53,37 +92,63 @@ def generate_structure(client, full_script):
     {full_script}
     """
     
-    try:
-        response = client.models.generate_content(
-            model=GEMINI_TEXT_MODEL_NAME,
-            contents=prompt
-        )
-        return response.text
-    except Exception as e:
-        return f"Error: {e}"
+    for attempt in range(3):
+        pieces = []
+        try:
+            for chunk in client.models.generate_content_stream(
+                model=GEMINI_TEXT_MODEL_NAME,
+                contents=prompt
+            ):
+                if chunk.text:
+                    pieces.append(chunk.text)
+                    if on_chunk:
+                        on_chunk(chunk.text)
+            return "".join(pieces)
+        except Exception as e:
+            # 스트림이 시작되기 전의 일시 오류만 재시도 (중간 실패 재시도는 미리보기 중복 출력)
+            if not pieces and attempt < 2 and _is_retryable_error(e):
+                time.sleep(2 ** attempt + random.random())
+                continue
+            return f"Error: {e}"
+
+def _raise_if_error(result_text):
+    """'Error: ...' 폴백 문자열을 예외로 변환 - 실패 결과가 st.cache_data에 저장되지 않게 함"""
+    if isinstance(result_text, str) and result_text.startswith("Error:"):
+        raise RuntimeError(result_text)
+    return result_text
+
+@st.cache_data(show_spinner=False, ttl=24 * 60 * 60)
+def cached_structure(key_digest, full_script, _api_key, _on_chunk=None):
+    """동일 대본에 대한 구조 분석을 재실행 시 캐시에서 즉시 반환 (Gemini 재호출 없음)"""
+    client = get_genai_client(_api_key)
+    return _raise_if_error(generate_structure(client, full_script, on_chunk=_on_chunk))
 
 # ==========================================
 # [함수] 2. 섹션별 대본 생성 (지침 기능 추가됨)
 # ==========================================
-def generate_section(client, section_title, full_structure, duration_type="fixed", custom_instruction=""):
+def get_length_guide(duration_type):
+    """duration_type('2min'/'3min'/'4min'/'fixed')에 따른 (목표 글자수, 작성 지침) 반환"""
+    if duration_type == "2min":
+        return ("약 1,000자 (공백 포함)", "핵심 내용 위주로 명확하게 전달하되, 너무 짧지 않게 서술하십시오.")
+    elif duration_type == "3min":
+        return ("약 1,500자 (공백 포함)", "충분한 예시와 설명을 곁들여 상세하게 서술하십시오.")
+    elif duration_type == "4min":
+        return ("약 2,000자 이상 (공백 포함)", "현미경으로 들여다보듯 아주 깊이 있고 디테일하게 묘사하십시오. 절대 요약하지 마십시오.")
+    else: # Intro / Epilogue (Fixed)
+        return ("약 400단어 (약 1,400자)", "시청자를 사로잡는 강력한 후킹과 여운을 주는 마무리로 작성하십시오. 안녕 인사는 하지 않는다")
+
+def estimate_section_tokens(duration_type):
+    """duration_type별 예상 출력 토큰 수 (목표 글자수의 약 1/2) - TPM 버킷 선차감용"""
+    return {"2min": 500, "3min": 750, "4min": 1000}.get(duration_type, 700)
+
+def build_section_prompt(section_title, full_structure, duration_type="fixed", custom_instruction=""):
     """
     duration_type: '2min', '3min', '4min', 'fixed'
     custom_instruction: 사용자가 입력한 추가 지침 (톤앤매너 등)
     """
-    
+
     # 1. 분량에 따른 글자수 및 지침 설정
-    if duration_type == "2min":
-        target_chars = "약 1,000자 (공백 포함)"
-        detail_level = "핵심 내용 위주로 명확하게 전달하되, 너무 짧지 않게 서술하십시오."
-    elif duration_type == "3min":
-        target_chars = "약 1,500자 (공백 포함)"
-        detail_level = "충분한 예시와 설명을 곁들여 상세하게 서술하십시오."
-    elif duration_type == "4min":
-        target_chars = "약 2,000자 이상 (공백 포함)"
-        detail_level = "현미경으로 들여다보듯 아주 깊이 있고 디테일하게 묘사하십시오. 절대 요약하지 마십시오."
-    else: # Intro / Epilogue (Fixed)
-        target_chars = "약 400단어 (약 1,400자)"
-        detail_level = "시청자를 사로잡는 강력한 후킹과 여운을 주는 마무리로 작성하십시오. 안녕 인사는 하지 않는다"
+    target_chars, detail_level = get_length_guide(duration_type)
 
     # [사용자 지침 반영]
     user_guide_prompt = ""
@@ -123,52 +188,244 @@ def generate_section(client, section_title, full_structure, duration_type="fixed
     [Output]
     (지금 바로 {section_title}의 원고를 작성 시작하세요)
     """
-    
+    return prompt
+
+def generate_section(client, section_title, full_structure, duration_type="fixed", custom_instruction="", on_chunk=None):
+    """단일 섹션 대본 생성 - 스트리밍 수신으로 토큰이 도착하는 대로 on_chunk에 전달"""
+    prompt = build_section_prompt(section_title, full_structure, duration_type, custom_instruction)
+    for attempt in range(3):
+        pieces = []
+        try:
+            for chunk in client.models.generate_content_stream(
+                model=GEMINI_TEXT_MODEL_NAME,
+                contents=prompt,
+                config=types.GenerateContentConfig(
+                    max_output_tokens=8192,
+                    temperature=0.75
+                )
+            ):
+                if chunk.text:
+                    pieces.append(chunk.text)
+                    if on_chunk:
+                        on_chunk(chunk.text)
+            return "".join(pieces)
+        except Exception as e:
+            # 스트림 시작 전의 일시 오류만 재시도 (중간 실패 재시도는 미리보기 중복 출력)
+            if not pieces and attempt < 2 and _is_retryable_error(e):
+                time.sleep(2 ** attempt + random.random())
+                continue
+            return f"Error: {e}"
+
+def _is_retryable_error(exc):
+    """429/리소스 고갈/일시적 5xx 계열만 재시도 대상으로 판단"""
+    msg = str(exc)
+    return any(tag in msg for tag in ("429", "RESOURCE_EXHAUSTED", "503", "UNAVAILABLE", "500", "DEADLINE_EXCEEDED"))
+
+def _retry_sync(call, attempts=3):
+    """동기 호출용 지수 백오프(+지터) 재시도 - 비동기 경로의 재시도 패턴과 동일한 판정 기준"""
+    for attempt in range(attempts):
+        try:
+            return call()
+        except Exception as e:
+            if attempt < attempts - 1 and _is_retryable_error(e):
+                time.sleep(2 ** attempt + random.random())
+                continue
+            raise
+
+async def generate_section_async(client, section_title, full_structure, duration_type="fixed", custom_instruction="", limiter=None):
+    """generate_section의 비동기 버전 (QPS 제한 + 429/5xx 지수 백오프 재시도)"""
+    prompt = build_section_prompt(section_title, full_structure, duration_type, custom_instruction)
+    for attempt in range(3):
+        try:
+            if limiter:
+                await limiter.acquire()
+            response = await client.aio.models.generate_content(
+                model=GEMINI_TEXT_MODEL_NAME,
+                contents=prompt,
+                config=types.GenerateContentConfig(
+                    max_output_tokens=8192,
+                    temperature=0.75
+                )
+            )
+            return response.text
+        except Exception as e:
+            if attempt < 2 and _is_retryable_error(e):
+                await asyncio.sleep(2 ** attempt + random.random())
+                continue
+            return f"Error: {e}"
+
+def normalize_for_cache(text):
+    """공백/개행만 다른 동일 입력이 캐시 미스가 되지 않도록 정규화한 키 텍스트 반환"""
+    return " ".join(text.split()) if text else ""
+
+@st.cache_data(show_spinner=False, ttl=24 * 60 * 60)
+def cached_section(key_digest, section_title, structure_key, duration_type, instruction_key, _api_key, _full_structure, _custom_instruction="", _on_chunk=None):
+    """
+    동일 조건(섹션/구조/분량/지침)의 섹션 생성 반복 클릭을 캐시에서 즉시 반환.
+    캐시 키에는 정규화된 텍스트(structure_key/instruction_key)를 쓰고,
+    실제 프롬프트에는 원본(_full_structure/_custom_instruction)을 사용한다.
+    """
+    client = get_genai_client(_api_key)
+    return _raise_if_error(generate_section(client, section_title, _full_structure, duration_type, _custom_instruction, on_chunk=_on_chunk))
+
+def generate_title_candidates(client, user_input_title, full_structure):
+    """입력 제목(있으면 변형, 없으면 구조 기반)으로 유튜브 제목 후보 5개 생성"""
+    if user_input_title:
+        prompt_instruction = f"""
+        [Target Title]
+        "{user_input_title}"
+        [Task]
+        Generate 5 variations of this title suitable for YouTube.
+        """
+    else:
+        prompt_instruction = """
+        [Task]
+        Read the provided script structure and generate 5 catchy YouTube video titles in Korean.
+        """
+
+    title_prompt = f"""
+    [Role] You are a YouTube viral marketing expert.
+    {prompt_instruction}
+    [Script Context]
+    {full_structure}
+    [Output Format]
+    - Output ONLY the list of 5 titles.
+    - No numbering (1., 2.), just 5 lines of text.
+    - Language: Korean
+    """
+    resp = _retry_sync(lambda: client.models.generate_content(
+        model=GEMINI_TEXT_MODEL_NAME,
+        contents=title_prompt
+    ))
+    return resp.text
+
+@st.cache_data(show_spinner=False, ttl=24 * 60 * 60)
+def cached_title_candidates(key_digest, user_title, structure_key, _api_key, _full_structure):
+    """동일 (입력 제목, 구조)에 대한 제목 추천 반복 클릭을 캐시에서 즉시 반환"""
+    client = get_genai_client(_api_key)
+    return generate_title_candidates(client, user_title, _full_structure)
+
+def generate_all_sections(client, full_structure, sections, custom_instruction=""):
+    """
+    모든 섹션을 한 번의 호출로 일괄 생성 (왕복 횟수 1회, 구조 컨텍스트도 1회만 전송)
+    sections: [(section_title, duration_type), ...]
+    반환: {section_title: 원고} - 파싱에 실패한 섹션은 빠질 수 있으므로 호출측에서 보완 필요
+    """
+    spec_lines = []
+    for title, duration_type in sections:
+        target_chars, detail_level = get_length_guide(duration_type)
+        spec_lines.append(f'- **{title}** / 목표 분량: {target_chars} / 작성 지침: {detail_level}')
+    section_specs = "\n".join(spec_lines)
+
+    user_guide_prompt = ""
+    if custom_instruction:
+        user_guide_prompt = f"""
+    [User's Special Direction]
+    The user has provided specific instructions for the tone/style. You MUST follow this:
+    👉 "{custom_instruction}"
+        """
+
+    prompt = f"""
+    [Role]
+    당신은 대한민국 최고의 유튜브 다큐멘터리 작가입니다.
+
+    [Task]
+    아래 전체 대본 구조를 바탕으로, [Target Sections]에 나열된 **모든 섹션의 원고를 빠짐없이** 작성하십시오.
+
+    [Context (Overall Structure)]
+    {full_structure}
+    {user_guide_prompt}
+
+    [Target Sections]
+    {section_specs}
+
+    [Output Format - 매우 중요]
+    각 섹션을 반드시 아래 형식 그대로 구분자로 감싸서 출력하십시오. 섹션 제목은 [Target Sections]의 제목과 정확히 일치해야 합니다.
+    <<<SECTION: 섹션 제목>>>
+    (해당 섹션의 나레이션 원고)
+    <<<END>>>
+
+    [Style Guidelines]
+    1. '습니다' 체를 사용하고, 다큐멘터리 특유의 진지하고 몰입감 있는 어조를 유지하세요. (단, [User's Special Direction]이 있다면 그것을 우선시하세요.)
+    2. 섹션 간 앞뒤 문맥이 자연스럽게 이어지도록 작성하세요.
+    3. (지문), (효과음) 같은 연출 지시어는 제외하고 **오직 나레이션 대사만** 출력하세요.
+    4. 서두에 "네, 알겠습니다" 같은 잡담을 하지 말고 바로 구분자부터 시작하세요.
+    5. 영문 병기는 하지 말고 한글로만 표기하세요.
+    6. 대본에는 챕터 표시를 하지 않는다.
+    """
+
     try:
         response = client.models.generate_content(
-            model=GEMINI_TEXT_MODEL_NAME, 
+            model=GEMINI_TEXT_MODEL_NAME,
             contents=prompt,
             config=types.GenerateContentConfig(
-                max_output_tokens=8192,
-                temperature=0.75 
+                max_output_tokens=min(65536, 8192 * len(sections)),
+                temperature=0.75
             )
         )
-        return response.text
-    except Exception as e:
-        return f"Error: {e}"
+        parsed = re.findall(r'<<<SECTION:\s*(.+?)\s*>>>(.*?)<<<END>>>', response.text, re.S)
+        return {title.strip(): body.strip() for title, body in parsed if body.strip()}
+    except Exception:
+        return {}
 
 # ==========================================
 # [함수] 3. 이미지 생성 관련 로직
 # ==========================================
 
-def init_folders():
-    if os.path.exists(IMAGE_OUTPUT_DIR):
-        try:
-            shutil.rmtree(IMAGE_OUTPUT_DIR)
-        except Exception:
-            pass
-    os.makedirs(IMAGE_OUTPUT_DIR, exist_ok=True)
-
+# 문장 분리용 정규식 (모듈 로드 시 1회만 컴파일)
+# - 한국어/CJK 종결 부호(。！？…)도 문장 경계로 인식
+# - 부호 뒤에 공백이 있어야 분리하므로 "3.14" 같은 소수점에서는 쪼개지지 않음
+# Streamlit은 상호작용마다 스크립트 전체를 재실행하므로, 매 rerun마다 쓰이는
+# 패턴은 모듈 로드 시 한 번만 컴파일해 둔다.
+_RE_TITLE = re.compile(r'^\s*1\.\s*\*\*(.*?)\*\*:\s*(.*)', re.MULTILINE)
+_RE_CHAPTER = re.compile(r'(?:Chapter|챕터)\s*\d+.*')
+_RE_PAREN = re.compile(r'\(.*?\)')
+_RE_NUMPREFIX = re.compile(r'^\d+\.\s*')
+_RE_FIXED_SECTION = re.compile(r'Intro|Epilogue|도입부|결론')
+
+def is_fixed_section(title):
+    """Intro/Epilogue처럼 고정 분량으로 쓰는 섹션인지 - 부분 문자열 4회 스캔 대신 단일 패스"""
+    return _RE_FIXED_SECTION.search(title) is not None
+
+@st.cache_data(show_spinner=False)
+def extract_chapters(structured):
+    """구조화 결과에서 챕터 제목을 순서 보존 + 중복 제거로 추출 (rerun마다 전체 재스캔 방지)"""
+    found = _RE_CHAPTER.findall(structured)
+    mids = list(dict.fromkeys(ch.replace('*', '').strip() for ch in found))
+    return ["Intro (도입부)", *mids, "Epilogue (결론)"]
+
+# ASCII 종결부호는 공백이 따라올 때만 경계 (3.14 같은 소수점 보호),
+# 전각(CJK) 종결부호는 보통 공백 없이 이어지므로 공백이 없어도 경계로 인정
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.?!])\s+|(?<=[。！？…])\s*')
+
+@st.cache_data(show_spinner=False)
 def split_script_by_time(script, chars_per_chunk=100):
-    # 문장 단위로 쪼개서 청크 만들기
-    temp_sentences = script.replace(".", ".|").replace("?", "?|").replace("!", "!|").split("|")
+    # 문장 단위로 쪼개서 청크 만들기 (단일 패스 분리 + list/join 누적으로 O(n))
     chunks = []
-    current_chunk = ""
-    for sentence in temp_sentences:
+    current = []
+    current_len = 0
+    for sentence in _SENTENCE_SPLIT_RE.split(script):
         sentence = sentence.strip()
         if not sentence: continue
-        if len(current_chunk) + len(sentence) < chars_per_chunk:
-            current_chunk += " " + sentence
+        if current_len + len(sentence) < chars_per_chunk:
+            current.append(sentence)
+            current_len += len(sentence) + 1
         else:
-            chunks.append(current_chunk.strip())
-            current_chunk = sentence
-    if current_chunk:
-        chunks.append(current_chunk.strip())
+            if current:
+                chunks.append(" ".join(current))
+            current = [sentence]
+            current_len = len(sentence)
+    if current:
+        chunks.append(" ".join(current))
     return chunks
 
+# 파일명에 쓸 수 없는 문자 제거용 변환 테이블 (정규식보다 빠른 단일 C 패스)
+_FNAME_STRIP = str.maketrans("", "", '\\/:*?"<>|')
+_TITLE_STRIP = str.maketrans("", "", '*"')
+
+@functools.lru_cache(maxsize=2048)
 def make_filename(scene_num, text_chunk):
-    clean_line = text_chunk.replace("\n", " ").strip()
-    clean_line = re.sub(r'[\\/:*?"<>|]', "", clean_line)
+    clean_line = text_chunk.replace("\n", " ").strip().translate(_FNAME_STRIP)
     words = clean_line.split()
     
     if len(words) <= 6:
@@ -181,13 +438,10 @@ def make_filename(scene_num, text_chunk):
     filename = f"S{scene_num:03d}_{summary}.png"
     return filename
 
-def generate_prompt(api_key, index, text_chunk, style_instruction, video_title):
-    scene_num = index + 1
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_TEXT_MODEL_NAME}:generateContent?key={api_key}"
-    headers = {'Content-Type': 'application/json'}
-
+def build_prompt_instruction(style_instruction, video_title):
+    """장면 공통 지시문(역할/테마/스타일) - 모든 장면에 동일하게 들어가는 정적 프리앰블"""
     # [수정] 지시문(Instruction) 자체를 전부 한글로 변경
-    full_instruction = f"""
+    return f"""
     [역할]
     당신은 세계적인 수준의 AI 아트 디렉터입니다.
 
@@ -214,59 +468,362 @@ def generate_prompt(api_key, index, text_chunk, style_instruction, video_title):
     - **무조건 한국어(한글)**로만 작성하십시오.
     - 부가적인 설명 없이 **오직 프롬프트 텍스트만** 출력하십시오.
     """
-    
-    payload = {
-        "contents": [{"parts": [{"text": f"지시사항(Instruction):\n{full_instruction}\n\n대본 내용(Script Segment):\n\"{text_chunk}\"\n\n이미지 프롬프트 결과:"}]}]
-    }
 
+def create_prompt_cache(client, style_instruction, video_title):
+    """정적 프리앰블을 Gemini 컨텍스트 캐시에 1회 업로드 (장면마다 재전송/재과금되지 않도록)"""
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        if response.status_code == 200:
-            try:
-                prompt = response.json()['candidates'][0]['content']['parts'][0]['text'].strip()
-            except:
-                prompt = text_chunk
-            return (scene_num, prompt)
-        elif response.status_code == 429:
-            time.sleep(2)
-            return (scene_num, f"장면 묘사: {text_chunk}")
-        else:
-            return (scene_num, f"Error generating prompt: {response.status_code}")
-    except Exception as e:
-        return (scene_num, f"Error: {e}")
+        cache = client.caches.create(
+            model=GEMINI_TEXT_MODEL_NAME,
+            config=types.CreateCachedContentConfig(
+                contents=[build_prompt_instruction(style_instruction, video_title)],
+                ttl="600s"
+            )
+        )
+        return cache.name
+    except Exception:
+        # SDK/모델이 컨텍스트 캐싱을 지원하지 않으면 프리앰블을 인라인으로 전송
+        return None
+
+async def generate_prompt(client, index, text_chunk, style_instruction, video_title, limiter=None, cached_content=None):
+    scene_num = index + 1
+
+    chunk_text = f"대본 내용(Script Segment):\n\"{text_chunk}\"\n\n이미지 프롬프트 결과:"
+    if cached_content:
+        # 공통 프리앰블은 컨텍스트 캐시에 있으므로 장면 텍스트만 전송
+        contents = chunk_text
+        config = types.GenerateContentConfig(cached_content=cached_content)
+    else:
+        full_instruction = build_prompt_instruction(style_instruction, video_title)
+        contents = f"지시사항(Instruction):\n{full_instruction}\n\n{chunk_text}"
+        config = None
 
-def generate_image(client, prompt, filename, output_dir, selected_model_name):
-    full_path = os.path.join(output_dir, filename)
+    for attempt in range(3):
+        try:
+            if limiter:
+                await limiter.acquire()
+            response = await client.aio.models.generate_content(
+                model=GEMINI_TEXT_MODEL_NAME,
+                contents=contents,
+                config=config
+            )
+            prompt = (response.text or "").strip()
+            return (scene_num, prompt if prompt else text_chunk)
+        except Exception as e:
+            if attempt < 2 and _is_retryable_error(e):
+                # 지수 백오프 + 지터 후 재시도 (품질 저하된 대체 프롬프트 대신 원래 결과를 보존)
+                await asyncio.sleep(2 ** attempt + random.random())
+                continue
+            return (scene_num, f"Error: {e}")
+    return (scene_num, f"장면 묘사: {text_chunk}")
+
+def _parse_prompts_json(text, valid_indices):
+    """
+    일괄 응답의 JSON 배열 파싱. 앞뒤 잡설이 붙어도 배열 부분만 추출해 복구.
+    모델이 지어낸 장면 번호(범위 밖/음수)가 다른 장면의 캐시를 오염시키지 않도록
+    해당 배치에 실제로 있던 인덱스만 통과시킴.
+    """
     try:
-        response = client.models.generate_content(
-            model=selected_model_name,
-            contents=[prompt],
-            config=types.GenerateContentConfig(
-                image_config=types.ImageConfig(aspect_ratio="16:9")
+        data = json.loads(text)
+    except (ValueError, TypeError):
+        match = re.search(r'\[.*\]', text or "", re.S)
+        if not match:
+            return {}
+        try:
+            data = json.loads(match.group(0))
+        except ValueError:
+            return {}
+    result = {}
+    if isinstance(data, list):
+        for item in data:
+            if isinstance(item, dict) and isinstance(item.get("prompt"), str) and item["prompt"].strip():
+                try:
+                    idx = int(item["scene"]) - 1
+                except (KeyError, ValueError, TypeError):
+                    continue
+                if idx in valid_indices:
+                    result[idx] = item["prompt"].strip()
+    return result
+
+async def generate_prompts_batch(client, indexed_chunks, style_instruction, video_title, limiter=None):
+    """
+    여러 장면의 이미지 프롬프트를 한 번의 호출로 일괄 생성 (왕복 횟수 + 프리앰블 반복 전송 제거).
+    indexed_chunks: [(index, chunk), ...] / 반환: {index: prompt} - 파싱 실패분은 빠질 수 있음
+    """
+    preamble = build_prompt_instruction(style_instruction, video_title)
+    numbered = "\n\n".join(f'[장면 {i + 1}]\n"{chunk}"' for i, chunk in indexed_chunks)
+    prompt = f"""지시사항(Instruction):
+{preamble}
+
+[추가 임무]
+아래에 여러 개의 대본 조각이 있습니다. **각 장면마다** 위 지시사항에 따라 이미지 프롬프트를 하나씩, 빠짐없이 작성하십시오.
+
+[출력 형식 - 매우 중요]
+아래 형태의 JSON 배열 **하나만** 출력하십시오. 다른 텍스트나 마크다운 코드 블록은 금지합니다.
+[{{"scene": 장면번호, "prompt": "해당 장면의 이미지 프롬프트"}}, ...]
+
+대본 조각(Script Segments):
+{numbered}"""
+
+    for attempt in range(3):
+        try:
+            if limiter:
+                await limiter.acquire()
+            response = await client.aio.models.generate_content(
+                model=GEMINI_TEXT_MODEL_NAME,
+                contents=prompt,
+                config=types.GenerateContentConfig(
+                    response_mime_type="application/json",
+                    max_output_tokens=min(65536, 2048 + 1024 * len(indexed_chunks))
+                )
             )
-        )
-        
+            return _parse_prompts_json(response.text, {i for i, _ in indexed_chunks})
+        except Exception as e:
+            if attempt < 2 and _is_retryable_error(e):
+                await asyncio.sleep((2 ** attempt) + random.uniform(0, 1))
+                continue
+            return {}
+    return {}
+
+# 장면 결과 디스크 캐시: 같은 (스타일|제목|대본 조각)이면 세션/앱 재시작 후에도
+# 프롬프트·이미지 생성을 통째로 건너뜀 (가장 비싼 경로 제거)
+SCENE_CACHE_DIR = ".scene_cache"
+
+def scene_cache_key(style_instruction, video_title, chunk):
+    return hashlib.sha256(f"{style_instruction}|{video_title}|{chunk}".encode()).hexdigest()[:16]
+
+def _load_scene_from_disk(key):
+    """캐시된 (프롬프트, PNG 바이트) 쌍을 반환. 둘 중 하나라도 없으면 미스 처리."""
+    png_path = os.path.join(SCENE_CACHE_DIR, f"{key}.png")
+    prompt_path = os.path.join(SCENE_CACHE_DIR, f"{key}.prompt.txt")
+    try:
+        with open(prompt_path, "r", encoding="utf-8") as f:
+            prompt_text = f.read()
+        with open(png_path, "rb") as f:
+            img_bytes = f.read()
+    except OSError:
+        return None
+    # 과거 버전이 남겼을 수 있는 오류 폴백 프롬프트는 미스로 처리
+    if prompt_text.strip() and img_bytes and not prompt_text.startswith("Error:"):
+        return prompt_text, img_bytes
+    return None
+
+def _store_scene_to_disk(key, prompt_text, img_bytes):
+    try:
+        os.makedirs(SCENE_CACHE_DIR, exist_ok=True)
+        with open(os.path.join(SCENE_CACHE_DIR, f"{key}.png"), "wb") as f:
+            f.write(img_bytes)
+        with open(os.path.join(SCENE_CACHE_DIR, f"{key}.prompt.txt"), "w", encoding="utf-8") as f:
+            f.write(prompt_text)
+    except OSError:
+        pass  # 캐시 실패는 결과에 영향 없음
+
+def _sections_cache_path(structured_content):
+    key = hashlib.sha256(normalize_for_cache(structured_content).encode()).hexdigest()[:16]
+    return os.path.join(SCENE_CACHE_DIR, f"sections_{key}.json")
+
+def load_saved_sections(structured_content):
+    """같은 구조로 생성해 둔 섹션 대본이 디스크에 있으면 복원 (세션 만료/재시작 대비)"""
+    try:
+        with open(_sections_cache_path(structured_content), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_sections(structured_content, section_scripts):
+    # 실패 폴백('Error: ...')은 저장하지 않음 - 다음 분석 때 대본처럼 복원되는 것을 방지
+    usable = {
+        title: text for title, text in section_scripts.items()
+        if text and not text.startswith("Error:")
+    }
+    try:
+        os.makedirs(SCENE_CACHE_DIR, exist_ok=True)
+        with open(_sections_cache_path(structured_content), "w", encoding="utf-8") as f:
+            json.dump(usable, f, ensure_ascii=False)
+    except OSError:
+        pass  # 캐시 실패는 결과에 영향 없음
+
+async def run_scene_pipeline(client, chunks, style_instruction, video_title,
+                             selected_model_name, max_parallel,
+                             qps=5, batch_size=6, cached_content=None, prompt_cache=None, on_progress=None):
+    """
+    프롬프트 확보(디스크/세션 캐시 → 일괄 호출 → 장면별 개별 호출 순) 후
+    장면별로 이미지 생성을 체인으로 연결해 하나의 이벤트 루프에서 처리.
+    """
+    limiter = AsyncRateLimiter(qps)
+    semaphore = asyncio.Semaphore(max_parallel)
+    total_steps = len(chunks) * 2
+    progress = {"done": 0}
+
+    def step(n=1):
+        progress["done"] += n
+        if on_progress:
+            on_progress(progress["done"], total_steps)
+
+    # 0) 디스크 캐시 히트 장면은 프롬프트+이미지를 모두 재사용 (호출 0회)
+    disk_hits = {}
+    for i, chunk in enumerate(chunks):
+        cached_pair = _load_scene_from_disk(scene_cache_key(style_instruction, video_title, chunk))
+        if cached_pair:
+            disk_hits[i] = cached_pair
+    if disk_hits:
+        step(len(disk_hits) * 2)
+
+    # 1) 세션 캐시에 있는 프롬프트 먼저 회수
+    prompt_map = {i: pair[0] for i, pair in disk_hits.items()}
+    for i, chunk in enumerate(chunks):
+        cache_key = (chunk, style_instruction, video_title)
+        if i not in prompt_map and prompt_cache is not None and cache_key in prompt_cache:
+            prompt_map[i] = prompt_cache[cache_key]
+            step()
+
+    # 2) 캐시에 없는 장면은 K개씩 묶어 일괄 호출하되, 모든 배치가 끝나기를 기다리지 않고
+    #    각 배치가 완료되는 즉시 future를 통해 해당 장면들의 이미지 생성이 시작되게 연결
+    missing = [(i, chunks[i]) for i in range(len(chunks)) if i not in prompt_map]
+    prompt_futures = {i: asyncio.get_running_loop().create_future() for i, _ in missing}
+
+    async def run_batch(batch):
+        batch_result = {}
+        try:
+            batch_result = await generate_prompts_batch(client, batch, style_instruction, video_title, limiter)
+            for i, prompt_text in batch_result.items():
+                if prompt_cache is not None:
+                    prompt_cache[(chunks[i], style_instruction, video_title)] = prompt_text
+            if batch_result:
+                step(len(batch_result))
+        finally:
+            # 누락분은 None으로 풀어줘서 대기 중인 장면이 개별 호출로 넘어가게 함
+            for i, _ in batch:
+                if not prompt_futures[i].done():
+                    prompt_futures[i].set_result(batch_result.get(i))
+
+    batch_tasks = [
+        asyncio.create_task(run_batch(missing[pos:pos + batch_size]))
+        for pos in range(0, len(missing), batch_size)
+    ]
+
+    async def run_one(index, chunk):
+        s_num = index + 1
+        if index in disk_hits:
+            prompt_text, img_bytes = disk_hits[index]
+            return {
+                "scene": s_num,
+                "filename": make_filename(s_num, chunk),
+                "script": chunk,
+                "prompt": prompt_text,
+                "bytes": img_bytes
+            }
+
+        if index in prompt_map:
+            prompt_text = prompt_map[index]
+        else:
+            prompt_text = await prompt_futures[index]
+            if prompt_text is None:
+                # 3) 일괄 응답에서 누락된 장면만 개별 호출 (One-or-all fallback)
+                s_num, prompt_text = await generate_prompt(
+                    client, index, chunk, style_instruction, video_title, limiter, cached_content
+                )
+                # 'Error: ...' 폴백은 세션 캐시에 넣지 않음 - 재실행 시 실제 재시도 유도
+                if prompt_cache is not None and not prompt_text.startswith("Error:"):
+                    prompt_cache[(chunk, style_instruction, video_title)] = prompt_text
+                step()
+
+        fname = make_filename(s_num, chunk)
+        img_bytes = await generate_image(client, prompt_text, selected_model_name, semaphore, limiter)
+        step()
+        if img_bytes:
+            if not prompt_text.startswith("Error:"):
+                # 다음 실행에서 재사용할 수 있도록 디스크에 보관 (쓰기는 루프 밖 스레드에서)
+                # 프롬프트가 오류 폴백이면 영구 캐시로 굳히지 않음
+                await asyncio.to_thread(
+                    _store_scene_to_disk,
+                    scene_cache_key(style_instruction, video_title, chunk),
+                    prompt_text, img_bytes
+                )
+            return {
+                "scene": s_num,
+                "filename": fname,
+                "script": chunk,
+                "prompt": prompt_text,
+                "bytes": img_bytes
+            }
+        return None
+
+    # gather는 입력 순서를 보존하므로 결과는 이미 장면 번호순 (별도 정렬 불필요)
+    outcomes = await asyncio.gather(*[run_one(i, chunk) for i, chunk in enumerate(chunks)])
+    if batch_tasks:
+        await asyncio.gather(*batch_tasks)
+    return [item for item in outcomes if item]
+
+def _transcode_to_png(img_data):
+    """PNG가 아닌 응답만 PNG로 변환 (CPU 작업이므로 이벤트 루프 밖 워커 스레드에서 실행)"""
+    converted = BytesIO()
+    Image.open(BytesIO(img_data)).save(converted, "PNG")
+    return converted.getvalue()
+
+async def generate_image(client, prompt, selected_model_name, semaphore, limiter=None):
+    """이미지 생성 후 PNG 바이트를 그대로 반환 (디스크를 거치지 않음)"""
+    try:
+        async with semaphore:
+            for attempt in range(3):
+                try:
+                    if limiter:
+                        # 시작 직후 수십 건이 한꺼번에 몰리지 않도록 버스트를 평탄화
+                        await limiter.acquire()
+                    response = await client.aio.models.generate_content(
+                        model=selected_model_name,
+                        contents=[prompt],
+                        config=types.GenerateContentConfig(
+                            image_config=types.ImageConfig(aspect_ratio="16:9")
+                        )
+                    )
+                    break
+                except Exception as e:
+                    if attempt < 2 and _is_retryable_error(e):
+                        await asyncio.sleep(2 ** attempt + random.random())
+                        continue
+                    raise
+
         if response.parts:
             for part in response.parts:
                 if part.inline_data:
                     img_data = part.inline_data.data
-                    image = Image.open(BytesIO(img_data))
-                    image.save(full_path)
-                    return full_path
+                    if part.inline_data.mime_type and part.inline_data.mime_type != "image/png":
+                        # PNG가 아닐 때만 변환 - 인코딩이 이벤트 루프를 막지 않도록 스레드로 위임
+                        img_data = await asyncio.to_thread(_transcode_to_png, img_data)
+                    return img_data
         return None
     except Exception as e:
         print(f"이미지 생성 에러: {e}")
         return None
 
-def create_zip_buffer(source_dir):
+@st.cache_data(show_spinner=False, max_entries=4)
+def create_zip_buffer(manifest, _results):
+    """
+    메모리에 있는 PNG 바이트를 디스크 재독 없이 바로 ZIP으로 묶음 (PNG는 이미 압축되어 있으므로 ZIP_STORED).
+    결과창의 어떤 위젯을 건드려도 rerun마다 다시 묶지 않도록, (파일명, 크기) 매니페스트를 캐시 키로 사용.
+    """
     buffer = BytesIO()
-    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                zip_file.write(file_path, os.path.basename(file_path))
-    buffer.seek(0)
-    return buffer
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+        for item in _results:
+            zip_file.writestr(item['filename'], item['bytes'])
+    return buffer.getvalue()
+
+def make_throttled_progress(progress_bar, min_interval=0.25):
+    """
+    완료 1건당 1회였던 progress 위젯 갱신을 min_interval 간격으로 묶음.
+    갱신마다 WebSocket 메시지 + 프런트 렌더가 발생하므로 장면 70+개 배치에서 체감 차이가 큼.
+    마지막(done == total) 갱신은 항상 반영.
+    """
+    state = {"last": 0.0}
+
+    def update(done, total):
+        now = time.monotonic()
+        if done >= total or now - state["last"] >= min_interval:
+            state["last"] = now
+            progress_bar.progress(done / total)
+
+    return update
 
 # ==========================================
 # [UI] 사이드바
@@ -303,6 +860,9 @@ with st.sidebar:
     style_instruction = st.text_area("AI에게 지시할 그림 스타일", value=default_style.strip(), height=200)
     st.markdown("---")
     max_workers = st.slider("작업 속도(병렬 수)", 1, 10, 5)
+    api_qps = st.slider("API 호출 속도 제한 (초당 요청 수)", 1, 20, 5, help="Gemini 할당량보다 낮게 유지하면 429 오류 없이 안정적으로 생성됩니다.")
+    prompts_per_batch = st.slider("Prompts per batch", 1, 12, 6, help="프롬프트 일괄 호출 시 한 번에 묶을 장면 수입니다. 크게 잡을수록 왕복이 줄고, 작게 잡을수록 응답이 빨리 나눠 도착합니다.")
+    api_tpm = st.number_input("토큰 사용량 제한 (분당 토큰, TPM)", min_value=10000, max_value=4000000, value=250000, step=10000, help="모델 할당량(TPM)보다 낮게 잡으면 동시 생성 시 후반 요청이 429로 밀리는 것을 막습니다.")
 
 # ==========================================
 # [UI] 메인 화면 1: 대본 구조화 및 생성
@@ -342,20 +902,37 @@ with st.container(border=True):
             # [중요] 사용자가 입력한 제목을 세션에 저장
             st.session_state['user_initial_title'] = user_title_input
 
-            client = genai.Client(api_key=api_key)
             with st.status("대본 내용 분석 중...", expanded=True) as status:
                 status.write(f"🧠 Gemini가 내용을 읽고 구조를 잡고 있습니다...")
-                result_text = generate_structure(client, raw_script)
-                
+
+                # 스트리밍 중간 결과를 실시간으로 보여줌 (체감 대기 시간 단축)
+                preview = status.empty()
+                stream_buf = []
+                def _on_structure_chunk(piece):
+                    stream_buf.append(piece)
+                    preview.markdown("".join(stream_buf))
+
+                try:
+                    result_text = cached_structure(api_key_digest(api_key), raw_script, api_key, _on_chunk=_on_structure_chunk)
+                except Exception as e:
+                    # 실패는 캐시되지 않으므로 재클릭하면 실제로 다시 호출됨
+                    preview.empty()
+                    status.update(label="❌ 분석에 실패했습니다. 다시 시도해주세요.", state="error", expanded=True)
+                    st.error(f"오류 발생: {e}")
+                    st.stop()
+                preview.empty()
+
                 st.session_state['structured_content'] = result_text
-                st.session_state['section_scripts'] = {} # 구조 바뀌면 대본 초기화
+                # 구조 바뀌면 대본 초기화 - 단, 같은 구조로 만들어 둔 대본이 디스크에 있으면 복원
+                st.session_state['section_scripts'] = load_saved_sections(result_text)
+                for saved_title, saved_text in st.session_state['section_scripts'].items():
+                    st.session_state[f"txt_{saved_title}"] = saved_text
 
-                # 제목 자동 추출 로직 (분석 결과에서 추출 시도)
-                import re
-                match = re.search(r'^\s*1\.\s*\*\*(.*?)\*\*:\s*(.*)', result_text, re.MULTILINE)
+                # 제목 자동 추출 로직 - 제목은 항상 응답 머리 부분에 있으므로 앞 512자만 스캔
+                match = _RE_TITLE.search(result_text[:512])
                 if match:
                     extracted = match.group(2).strip() if match.group(2).strip() else match.group(1).strip()
-                    st.session_state['video_title'] = re.sub(r'\(.*?\)', '', extracted).strip()
+                    st.session_state['video_title'] = _RE_PAREN.sub('', extracted).strip()
                 else:
                     # 추출 실패 시 사용자가 입력한 제목이 있으면 그걸 쓰고, 없으면 제목 없음 처리
                     st.session_state['video_title'] = user_title_input if user_title_input else "제목을 찾을 수 없음"
@@ -374,18 +951,10 @@ if st.session_state['structured_content']:
     st.subheader("⚡ 롱폼 대본 전체 일괄 생성 (병렬 처리)")
     st.caption("🚀 버튼 한번으로 모든 챕터를 동시에 작성합니다. (15분/20분/25분 옵션)")
 
-    # 챕터 목록 추출
-    lines = st.session_state['structured_content'].split('\n')
-    chapter_titles = ["Intro (도입부)"]
-    found_chapters = re.findall(r'(?:Chapter|챕터)\s*\d+.*', st.session_state['structured_content'])
-    seen = set()
-    for ch in found_chapters:
-        clean_ch = ch.replace('*', '').strip()
-        if clean_ch not in seen:
-            chapter_titles.append(clean_ch)
-            seen.add(clean_ch)
-    chapter_titles.append("Epilogue (결론)")
-    
+    # 챕터 목록 추출 (구조가 같으면 캐시에서 즉시 반환)
+    chapter_titles = extract_chapters(st.session_state['structured_content'])
+
+
     for title in chapter_titles:
         if title not in st.session_state['section_scripts']:
             st.session_state['section_scripts'][title] = ""
@@ -420,97 +989,145 @@ if st.session_state['structured_content']:
         if not api_key:
             st.error("⚠️ API Key가 필요합니다.")
         else:
-            client = genai.Client(api_key=api_key)
+            client = get_genai_client(api_key)
             status_box = st.status("🚀 AI가 지침을 반영하여 모든 챕터를 작성 중입니다...", expanded=True)
             progress_bar = status_box.progress(0)
-            
+            update_progress = make_throttled_progress(progress_bar)
+
             total_tasks = len(chapter_titles)
             completed_tasks = 0
-            
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                future_to_title = {}
-                for title in chapter_titles:
-                    is_fixed = any(x in title for x in ["Intro", "Epilogue", "도입부", "결론"])
-                    current_duration = "fixed" if is_fixed else batch_duration_type
-                    
-                    # 지침 전달
-                    future = executor.submit(
-                        generate_section, 
-                        client, 
-                        title, 
-                        st.session_state['structured_content'], 
-                        current_duration, 
-                        batch_instruction
-                    )
-                    future_to_title[future] = title
-                
-                for future in as_completed(future_to_title):
-                    title = future_to_title[future]
-                    try:
-                        result_text = future.result()
+
+            sections = [
+                (title, "fixed" if is_fixed_section(title) else batch_duration_type)
+                for title in chapter_titles
+            ]
+
+            # 1차: 모든 섹션을 단 한 번의 호출로 일괄 생성
+            status_box.write("⚡ 모든 챕터를 하나의 요청으로 일괄 생성 중...")
+            batch_results = generate_all_sections(
+                client,
+                st.session_state['structured_content'],
+                sections,
+                batch_instruction
+            )
+
+            for title, result_text in batch_results.items():
+                if title in st.session_state['section_scripts']:
+                    st.session_state['section_scripts'][title] = result_text
+                    st.session_state[f"txt_{title}"] = result_text # 화면 동기화
+                    completed_tasks += 1
+                    update_progress(completed_tasks, total_tasks)
+                    status_box.write(f"✅ 완료: {title}")
+
+            # 2차(Fallback): 일괄 응답에서 누락된 섹션만 병렬로 개별 생성
+            missing = [(t, d) for t, d in sections if not st.session_state['section_scripts'].get(t)]
+            if missing:
+                status_box.write(f"♻️ 누락된 {len(missing)}개 섹션을 개별 생성 중...")
+                progress_state = {"done": completed_tasks}
+
+                async def _generate_missing():
+                    limiter = AsyncRateLimiter(api_qps)
+                    # RPS와 별개로 TPM도 선차감 - 큰 섹션 여러 개가 동시에 나가 TPS 한도를 넘지 않도록
+                    token_bucket = AsyncRateLimiter(api_tpm, 60.0)
+
+                    async def one(title, duration):
+                        await token_bucket.acquire(estimate_section_tokens(duration))
+                        return title, await generate_section_async(
+                            client, title, st.session_state['structured_content'], duration, batch_instruction, limiter
+                        )
+
+                    for task in asyncio.as_completed([asyncio.create_task(one(t, d)) for t, d in missing]):
+                        title, result_text = await task
                         st.session_state['section_scripts'][title] = result_text
                         st.session_state[f"txt_{title}"] = result_text # 화면 동기화
-                        completed_tasks += 1
-                        progress_bar.progress(completed_tasks / total_tasks)
+                        progress_state["done"] += 1
+                        update_progress(progress_state["done"], total_tasks)
                         status_box.write(f"✅ 완료: {title}")
-                    except Exception as e:
-                        status_box.error(f"❌ 실패 ({title}): {e}")
+
+                asyncio.run(_generate_missing())
             
+            save_sections(st.session_state['structured_content'], st.session_state['section_scripts'])
             status_box.update(label="✨ 전체 생성 완료! 아래에서 확인하세요.", state="complete", expanded=False)
             time.sleep(1)
             st.rerun()
 
-    # 섹션별 확인 및 수정
-    st.subheader("📝 섹션별 확인 및 수정")
-    full_combined_script = ""
-    
-    for title in chapter_titles:
-        with st.expander(f"📌 {title}", expanded=False):
-            is_intro_epilogue = any(x in title for x in ["Intro", "Epilogue", "도입부", "결론"])
-            
-            if is_intro_epilogue:
-                if st.button(f"🔄 {title} 다시 생성", key=f"r_fix_{title}"):
-                    client = genai.Client(api_key=api_key)
-                    with st.spinner("재생성 중..."):
-                        # 재생성 시에는 기본값(지침 없음) or 필요시 수정 가능
-                        result = generate_section(client, title, st.session_state['structured_content'], "fixed")
-                        st.session_state['section_scripts'][title] = result
-                        st.session_state[f"txt_{title}"] = result 
-                        st.rerun()
+    # 섹션 편집과 최종 병합 패널은 한 프래그먼트로 묶음 - 텍스트 수정/재생성 시
+    # 스크립트 전체가 아니라 이 영역만 다시 실행됨 (최종 대본은 편집 내용에 의존하므로 함께 갱신)
+    @st.fragment
+    def _render_sections(chapter_titles):
+        st.subheader("📝 섹션별 확인 및 수정")
+        # rerun마다 수십 번 반복되는 session_state 프록시 조회를 지역 변수로 스냅샷
+        ss = st.session_state
+        section_scripts = ss['section_scripts']
+        structured = ss['structured_content']
+        combined_parts = []
+
+        # 선택된 챕터 하나만 편집 위젯을 실제로 그림 - 나머지는 요약 한 줄만 출력
+        # (챕터 10개 x 위젯 4개를 rerun마다 브라우저로 전송하던 페이로드 제거)
+        selected_title = st.selectbox("✏️ 확인/수정할 섹션", chapter_titles, key="open_section")
+
+        for title in chapter_titles:
+            if title != selected_title:
+                st.caption(f"📌 {title} - {len(section_scripts.get(title) or ''):,}자")
             else:
-                c_cols = st.columns(3)
-                def regen(dur):
-                    client = genai.Client(api_key=api_key)
-                    with st.spinner(f"{dur} 모드로 재생성 중..."):
-                        dur_code = "2min" if "2분" in dur else "3min" if "3분" in dur else "4min"
-                        result = generate_section(client, title, st.session_state['structured_content'], dur_code)
-                        st.session_state['section_scripts'][title] = result
-                        st.session_state[f"txt_{title}"] = result
-                        st.rerun()
-
-                if c_cols[0].button("🔄 다시 생성 (2분)", key=f"r2_{title}"): regen("2분")
-                if c_cols[1].button("🔄 다시 생성 (3분)", key=f"r3_{title}"): regen("3분")
-                if c_cols[2].button("🔄 다시 생성 (4분)", key=f"r4_{title}"): regen("4분")
-
-            if f"txt_{title}" not in st.session_state:
-                st.session_state[f"txt_{title}"] = st.session_state['section_scripts'].get(title, "")
-
-            new_text = st.text_area(label="📜 대본 내용 (수정 가능)", height=300, key=f"txt_{title}")
-            st.session_state['section_scripts'][title] = new_text
-        
-        if st.session_state['section_scripts'].get(title):
-            full_combined_script += st.session_state['section_scripts'][title] + "\n\n"
-
-    # 최종 병합 결과
-    if full_combined_script:
-        st.divider()
-        st.subheader("📦 최종 완성 대본")
-        col_info, col_down = st.columns([3, 1])
-        with col_info:
-            st.caption(f"📝 총 글자 수: {len(full_combined_script)}자 (공백 포함)")
-        with col_down:
-            st.download_button(label="💾 대본 다운로드 (.txt)", data=full_combined_script, file_name="final_script.txt", mime="text/plain", use_container_width=True)
-        st.text_area("아래 내용을 복사하거나 위 버튼을 눌러 저장하세요", value=full_combined_script, height=500)
+                with st.container(border=True):
+                    st.markdown(f"**📌 {title}**")
+                    # 재생성 중간 결과를 실시간 표시 (캐시 히트 시에는 즉시 반환되어 그대로 건너뜀)
+                    stream_preview = st.empty()
+                    stream_buf = []
+                    def _on_section_chunk(piece):
+                        stream_buf.append(piece)
+                        stream_preview.markdown("".join(stream_buf))
+
+                    # 실패는 캐시되지 않고 예외로 올라오므로, 재클릭하면 실제로 다시 호출됨
+                    def regen(dur_code):
+                        with st.spinner("재생성 중..."):
+                            try:
+                                result = cached_section(api_key_digest(api_key), title, normalize_for_cache(structured), dur_code, "", api_key, structured, _on_chunk=_on_section_chunk)
+                            except Exception as e:
+                                stream_preview.empty()
+                                st.error(f"재생성 실패: {e}")
+                                return
+                            stream_preview.empty()
+                            section_scripts[title] = result
+                            ss[f"txt_{title}"] = result
+                            save_sections(structured, section_scripts)
+                            st.rerun(scope="fragment")
+
+                    if is_fixed_section(title):
+                        # 재생성 시에는 기본값(지침 없음) or 필요시 수정 가능
+                        if st.button(f"🔄 {title} 다시 생성", key=f"r_fix_{title}"): regen("fixed")
+                    else:
+                        c_cols = st.columns(3)
+                        if c_cols[0].button("🔄 다시 생성 (2분)", key=f"r2_{title}"): regen("2min")
+                        if c_cols[1].button("🔄 다시 생성 (3분)", key=f"r3_{title}"): regen("3min")
+                        if c_cols[2].button("🔄 다시 생성 (4분)", key=f"r4_{title}"): regen("4min")
+
+                    if f"txt_{title}" not in ss:
+                        ss[f"txt_{title}"] = section_scripts.get(title, "")
+
+                    new_text = st.text_area(label="📜 대본 내용 (수정 가능)", height=300, key=f"txt_{title}")
+                    # 값이 실제로 바뀐 경우에만 기록 (rerun마다 N개 섹션을 무조건 다시 쓰지 않음)
+                    if section_scripts.get(title) != new_text:
+                        section_scripts[title] = new_text
+                        save_sections(structured, section_scripts)
+
+            if section_scripts.get(title):
+                combined_parts.append(section_scripts[title])
+
+        # 최종 병합 결과 (누적 += 는 O(n²)이므로 join으로 한 번에 병합)
+        full_combined_script = "\n\n".join(combined_parts) + "\n\n" if combined_parts else ""
+        if full_combined_script:
+            st.divider()
+            st.subheader("📦 최종 완성 대본")
+            col_info, col_down = st.columns([3, 1])
+            with col_info:
+                st.caption(f"📝 총 글자 수: {len(full_combined_script)}자 (공백 포함)")
+            with col_down:
+                st.download_button(label="💾 대본 다운로드 (.txt)", data=full_combined_script, file_name="final_script.txt", mime="text/plain", use_container_width=True)
+            st.text_area("아래 내용을 복사하거나 위 버튼을 눌러 저장하세요", value=full_combined_script, height=500)
+
+    _render_sections(chapter_titles)
 
 # ==========================================
 # [수정된 UI] 메인 화면 3: 이미지 생성 (제목 유지 버그 수정됨)
@@ -540,49 +1157,25 @@ with col_title_btn:
         elif not st.session_state.get('structured_content'):
             st.warning("먼저 '구조 분석'을 실행하세요.")
         else:
-            client = genai.Client(api_key=api_key)
             with st.spinner("AI가 최적의 제목을 고민 중입니다..."):
-                
+
                 # 사용자가 입력해둔 값이 있으면 그걸 바탕으로, 없으면 대본 전체로 추천
                 user_input_title = st.session_state['video_title'].strip()
-                
-                if user_input_title:
-                    prompt_instruction = f"""
-                    [Target Title]
-                    "{user_input_title}"
-                    [Task]
-                    Generate 5 variations of this title suitable for YouTube.
-                    """
-                else:
-                    prompt_instruction = f"""
-                    [Task]
-                    Read the provided script structure and generate 5 catchy YouTube video titles in Korean.
-                    """
-
-                title_prompt = f"""
-                [Role] You are a YouTube viral marketing expert.
-                {prompt_instruction}
-                [Script Context]
-                {st.session_state['structured_content']}
-                [Output Format]
-                - Output ONLY the list of 5 titles.
-                - No numbering (1., 2.), just 5 lines of text.
-                - Language: Korean
-                """
-                
+
                 try:
-                    resp = client.models.generate_content(
-                        model=GEMINI_TEXT_MODEL_NAME, 
-                        contents=title_prompt
+                    # 동일 (제목, 구조) 재클릭은 캐시 히트 (Gemini 재호출 없음)
+                    raw_titles = cached_title_candidates(
+                        api_key_digest(api_key),
+                        user_input_title,
+                        normalize_for_cache(st.session_state['structured_content']),
+                        api_key,
+                        st.session_state['structured_content']
+                    )
+                    cleaned = (
+                        _RE_NUMPREFIX.sub('', line).translate(_TITLE_STRIP).strip()
+                        for line in raw_titles.splitlines() if line.strip()
                     )
-                    candidates = [line.strip() for line in resp.text.split('\n') if line.strip()]
-                    clean_candidates = []
-                    import re
-                    for c in candidates:
-                        clean = re.sub(r'^\d+\.\s*', '', c).replace('*', '').replace('"', '').strip()
-                        if clean: clean_candidates.append(clean)
-                    
-                    st.session_state['title_candidates'] = clean_candidates[:5]
+                    st.session_state['title_candidates'] = [c for c in cleaned if c][:5]
                 except Exception as e:
                     st.error(f"오류 발생: {e}")
 
@@ -624,13 +1217,15 @@ if st.session_state['title_candidates']:
 # --- 기존 대본 가져오기 및 입력창 ---
 # (이 부분은 이전 코드 흐름과 자연스럽게 이어지도록 유지)
 if 'section_scripts' in st.session_state and st.session_state['section_scripts']:
-    intro_text_acc = ""
-    main_text_acc = ""
+    intro_parts = []
+    main_parts = []
     for title_key, text in st.session_state['section_scripts'].items():
         if "Intro" in title_key or "도입부" in title_key:
-            intro_text_acc += text + "\n\n"
+            intro_parts.append(text)
         else:
-            main_text_acc += text + "\n\n"
+            main_parts.append(text)
+    intro_text_acc = "\n\n".join(intro_parts)
+    main_text_acc = "\n\n".join(main_parts)
             
     st.write("👇 **생성된 대본 가져오기 (클릭 시 아래 입력창에 채워집니다)**")
     
@@ -673,10 +1268,9 @@ if start_btn:
     # [수정] 제목이 없어도 실행되도록 강제 확인 로직(elif)을 삭제했습니다.
     else:
         st.session_state['is_processing'] = True
-        st.session_state['generated_results'] = [] 
-        
-        init_folders()
-        client = genai.Client(api_key=api_key)
+        st.session_state['generated_results'] = []
+
+        client = get_genai_client(api_key)
         
         status_box = st.status("작업 진행 중...", expanded=True)
         progress_bar = st.progress(0)
@@ -692,52 +1286,21 @@ if start_btn:
         if not current_video_title:
             current_video_title = "전반적인 대본 분위기에 어울리는 배경 (Context based on the script)"
 
-        # 2. 프롬프트 생성 (병렬)
-        status_box.write(f"📝 프롬프트 작성 중 ({GEMINI_TEXT_MODEL_NAME}) - 기준 테마: {current_video_title}...")
-        prompts = []
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = []
-            
-            for i, chunk in enumerate(chunks):
-                # 수정된 current_video_title 변수를 사용
-                futures.append(executor.submit(generate_prompt, api_key, i, chunk, style_instruction, current_video_title))
-            
-            for i, future in enumerate(as_completed(futures)):
-                prompts.append(future.result())
-                progress_bar.progress((i + 1) / (total_scenes * 2))
-        
-        prompts.sort(key=lambda x: x[0])
-        
-        # 3. 이미지 생성 (병렬)
-        status_box.write(f"🎨 이미지 생성 중 ({SELECTED_IMAGE_MODEL})...")
-        results = []
-        
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_meta = {}
-            for s_num, prompt_text in prompts:
-                idx = s_num - 1
-                orig_text = chunks[idx]
-                fname = make_filename(s_num, orig_text)
-                
-                future = executor.submit(generate_image, client, prompt_text, fname, IMAGE_OUTPUT_DIR, SELECTED_IMAGE_MODEL)
-                future_to_meta[future] = (s_num, fname, orig_text, prompt_text)
-            
-            completed_cnt = 0
-            for future in as_completed(future_to_meta):
-                s_num, fname, orig_text, p_text = future_to_meta[future]
-                path = future.result()
-                if path:
-                    results.append({
-                        "scene": s_num,
-                        "path": path,
-                        "filename": fname,
-                        "script": orig_text,
-                        "prompt": p_text
-                    })
-                completed_cnt += 1
-                progress_bar.progress(0.5 + (completed_cnt / total_scenes * 0.5))
-        
-        results.sort(key=lambda x: x['scene'])
+        # 2+3. 프롬프트 생성 → 이미지 생성 파이프라인 (장면별 체인, 두 단계 중첩 실행)
+        status_box.write(f"📝 프롬프트 작성 ({GEMINI_TEXT_MODEL_NAME}) + 🎨 이미지 생성 ({SELECTED_IMAGE_MODEL}) - 기준 테마: {current_video_title}...")
+        if 'prompt_cache' not in st.session_state:
+            st.session_state['prompt_cache'] = {}
+        context_cache_name = create_prompt_cache(client, style_instruction, current_video_title)
+
+        results = asyncio.run(run_scene_pipeline(
+            client, chunks, style_instruction, current_video_title,
+            SELECTED_IMAGE_MODEL, max_workers,
+            qps=api_qps,
+            batch_size=prompts_per_batch,
+            cached_content=context_cache_name,
+            prompt_cache=st.session_state['prompt_cache'],
+            on_progress=make_throttled_progress(progress_bar)
+        ))
         st.session_state['generated_results'] = results
         
         status_box.update(label="✅ 완료되었습니다!", state="complete", expanded=False)
@@ -746,29 +1309,34 @@ if start_btn:
 # 결과창
 if st.session_state['generated_results']:
     st.divider()
-    col1, col2 = st.columns([3, 1])
-    with col1:
-        st.header(f"📸 결과물 ({len(st.session_state['generated_results'])}장)")
-    with col2:
-        zip_data = create_zip_buffer(IMAGE_OUTPUT_DIR)
-        st.download_button("📦 전체 ZIP 다운로드", data=zip_data, file_name="all_images.zip", mime="application/zip", use_container_width=True)
-    
-    for item in st.session_state['generated_results']:
-        with st.container(border=True):
-            cols = st.columns([1, 2])
-            with cols[0]:
-                try: st.image(item['path'], use_container_width=True)
-                except: st.error("이미지 없음")
-            with cols[1]:
-                st.subheader(f"Scene {item['scene']:02d}")
-                st.caption(f"파일명: {item['filename']}")
-                st.write(f"**대본:** {item['script']}")
-                with st.expander("프롬프트 확인"):
-                    st.text(item['prompt'])
-                try:
-                    with open(item['path'], "rb") as file:
-                        st.download_button("⬇️ 저장", data=file, file_name=item['filename'], mime="image/png", key=f"btn_down_{item['scene']}")
-                except: st.error("파일 오류")
+
+    # 갤러리 내부 상호작용(확장/다운로드)이 전체 스크립트 rerun을 유발하지 않도록 프래그먼트로 분리
+    @st.fragment
+    def _render_results():
+        results = st.session_state['generated_results']
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.header(f"📸 결과물 ({len(results)}장)")
+        with col2:
+            zip_manifest = tuple((item['filename'], len(item['bytes'])) for item in results)
+            zip_data = create_zip_buffer(zip_manifest, results)
+            st.download_button("📦 전체 ZIP 다운로드", data=zip_data, file_name="all_images.zip", mime="application/zip", use_container_width=True)
+
+        for item in results:
+            with st.container(border=True):
+                cols = st.columns([1, 2])
+                with cols[0]:
+                    try: st.image(BytesIO(item['bytes']), use_container_width=True)
+                    except: st.error("이미지 없음")
+                with cols[1]:
+                    st.subheader(f"Scene {item['scene']:02d}")
+                    st.caption(f"파일명: {item['filename']}")
+                    st.write(f"**대본:** {item['script']}")
+                    with st.expander("프롬프트 확인"):
+                        st.text(item['prompt'])
+                    st.download_button("⬇️ 저장", data=item['bytes'], file_name=item['filename'], mime="image/png", key=f"btn_down_{item['scene']}")
+
+    _render_results()
 
 
 